@@ -2,18 +2,54 @@ import os
 import csv
 import argparse
 import random
-from datetime import datetime, timedelta
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, timedelta
+from functools import lru_cache, partial
+from itertools import islice
 
-# Create the argument parser
-parser = argparse.ArgumentParser(description='Predict values of stock price.')
+# Seed the random generator once, from OS entropy
+random.seed()
 
-# Add the required arguments
-parser.add_argument('--n', type=int, required=True, help='Number of files to process')
-parser.add_argument('--input', type=str, required=True, help='Path to the input files')
-parser.add_argument('--output', type=str, required=True, help='Path to the output files')
+# Block size used to read back from the end of the file to its last 10 rows,
+# files up to this size are read whole
+SAMPLE_SPAN = 4096
 
-# Parse the arguments
-args = parser.parse_args()
+# Day offsets of the predicted values from the last sampled row
+PREDICTION_OFFSETS = (timedelta(days=1), timedelta(days=2), timedelta(days=3))
+
+
+@lru_cache(maxsize=65536)
+def parse_date(timestamp):
+    """
+    Parses a dd-mm-yyyy timestamp.
+
+    The fields are split by hand, as strptime goes through a regex on every call.
+
+    Args:
+        timestamp (str): The timestamp to parse.
+
+    Returns:
+        date: The parsed date.
+    """
+    day, month, year = timestamp.split('-')
+    return date(int(year), int(month), int(day))
+
+
+@lru_cache(maxsize=65536)
+def format_date(timestamp):
+    """
+    Formats a date as dd-mm-yyyy.
+
+    The fields are formatted directly, as strftime interprets the format string on every call.
+
+    Args:
+        timestamp (date): The date to format.
+
+    Returns:
+        str: The formatted date.
+    """
+    return f"{timestamp.day:02d}-{timestamp.month:02d}-{timestamp.year:04d}"
 
 
 def generate_random_start_row(total_row_count):
@@ -30,12 +66,43 @@ def generate_random_start_row(total_row_count):
     if total_row_count < 10:
         return 0
 
-    # Seed with the current timestamp
-    current_timestamp = datetime.now().timestamp()
-    random.seed(current_timestamp)
-
     # Ensure the start row is valid
-    return random.randint(0, total_row_count-10)
+    return random.randrange(total_row_count - 9)
+
+
+def find_last_rows_offset(file, file_size):
+    """
+    Finds the byte offset where the last 10 rows of a file start.
+
+    Args:
+        file (BufferedReader): The file opened in binary mode.
+        file_size (int): The size of the file in bytes.
+
+    Returns:
+        int: The byte offset of the 10th row from the end, or 0 if the file has fewer rows.
+    """
+    tail_offset = file_size
+    tail = b''
+
+    # Read the file backwards one sample span at a time, until the tail holds 10 rows
+    while tail_offset > 0:
+        block_offset = max(0, tail_offset - SAMPLE_SPAN)
+        file.seek(block_offset)
+        tail = file.read(tail_offset - block_offset) + tail
+        tail_offset = block_offset
+
+        # Step back over 10 line breaks, ignoring the trailing ones
+        position = len(tail.rstrip())
+
+        for _ in range(10):
+            position = tail.rfind(b'\n', 0, position)
+
+            if position == -1:
+                break
+        else:
+            return tail_offset + position + 1
+
+    return 0
 
 
 def get_random_rows(file_path):
@@ -46,43 +113,88 @@ def get_random_rows(file_path):
         file_path (str): The path to the file.
 
     Returns:
-        list of dict: A list with the 10 random rows.
+        dict of list: The Stock-ID, Timestamp and Stock Price Value columns of the 10 random rows.
     """
-    try:
-        # Get the total number of rows in the file
-        with open(file_path, mode='r', encoding='utf-8') as file:
-            total_row_count = sum(1 for _ in file)
-
-            # Generate a random starting row
-            start_row = generate_random_start_row(total_row_count)
+    file_size = os.path.getsize(file_path)
 
-            random_rows = []
-            current_row = 0
+    with open(file_path, mode='rb') as file:
+        if file_size > SAMPLE_SPAN:
+            last_rows_offset = find_last_rows_offset(file, file_size)
 
-            # Read the file and extract the random rows
+            # Draw a byte offset up to the last 10 rows and sample from the first row starting
+            # at or after it. Offsets below 0 stand for the first row, weighting it by its
+            # length as every other row is weighted by the length of the row before it
             file.seek(0)
+            first_row_length = len(file.readline())
+            offset = random.randrange(last_rows_offset + first_row_length) - first_row_length + 1
+
+            if offset > 0:
+                # Resync from the byte before, so a row starting exactly at the offset is kept
+                file.seek(offset - 1)
+                file.readline()
+            else:
+                file.seek(0)
+
+            lines = [file.readline() for _ in range(10)]
+        else:
+            # Small files are read whole and sampled by row number
+            all_lines = file.readlines()
+            start_row = generate_random_start_row(len(all_lines))
+            lines = all_lines[start_row:start_row + 10]
+
+    # Decode the sampled block at once and split it into fields
+    splitted_rows = [
+        line.strip().split(',')[:3]
+        for line in b''.join(lines).decode('utf-8').splitlines()
+        if line.strip()
+    ]
+
+    if not splitted_rows:
+        return {'Stock-ID': [], 'Timestamp': [], 'Stock Price Value': []}
+
+    # Convert each column in bulk rather than field by field
+    stock_ids, timestamps, stock_price_values = zip(*splitted_rows)
+
+    random_rows = {
+        'Stock-ID': list(stock_ids),
+        'Timestamp': list(map(parse_date, timestamps)),
+        'Stock Price Value': list(map(float, stock_price_values))
+    }
 
-            for row in file:
-                if current_row >= start_row + 10:
-                    break
-
-                if current_row >= start_row:
-                    splitted_row = row.strip().split(',')
-                    random_rows.append({
-                        'Stock-ID': splitted_row[0],
-                        'Timestamp': datetime.strptime(splitted_row[1], "%d-%m-%Y").date(),
-                        'Stock Price Value': float(splitted_row[2])
-                    })
-                current_row += 1
-
-        return random_rows
-
-    except FileNotFoundError:
-        print(f'ERROR: The file {file_path} does not exist.')
-    except PermissionError:
-        print(f'ERROR: Permission denied for accessing {file_path}.')
-    except Exception as e:
-        print(f'ERROR: An unexpected error occurred: {e}')
+    return random_rows
+
+
+def predict_prices(stock_price_values):
+    """
+    Calculates the next 3 stock price values from a column of prices.
+
+    Args:
+        stock_price_values (list of float): The Stock Price Values column.
+
+    Returns:
+        tuple of float: The 3 predicted values, or None if there are fewer than 2 unique values.
+    """
+    # Find the two largest unique Stock Price Values in a single pass
+    largest = second_largest = float('-inf')
+
+    for value in stock_price_values:
+        if value > largest:
+            second_largest = largest
+            largest = value
+        elif largest > value > second_largest:
+            second_largest = value
+
+    if second_largest == float('-inf'):
+        return None
+
+    # Get the last value and calculate the next 3 predicted values
+    n = stock_price_values[-1]
+
+    first = second_largest
+    second = round(first + (n - first)/2, 2)
+    third = round(second + (first - second)/4, 2)
+
+    return first, second, third
 
 
 def predict_next_values(random_rows):
@@ -90,31 +202,23 @@ def predict_next_values(random_rows):
     Predicts the next 3 stock price values.
 
     Args:
-        random_rows (list of dict): List containing stock rows.
+        random_rows (dict of list): Columns containing stock rows.
 
     Returns:
-        list of dict: Updated list of random rows and the new predicted values.
+        dict of list: Updated columns of random rows and the new predicted values, or None if
+        the values can't be predicted.
     """
-    # Generate a set of sorted unique Stock Price Values
-    unique_stock_price_values = set([row['Stock Price Value'] for row in random_rows])
-    sorted_stock_price_values = sorted(unique_stock_price_values, reverse=True)
+    predicted_values = predict_prices(random_rows['Stock Price Value'])
 
-    # Get the last value and create the predicted values list
-    n = random_rows[-1]['Stock Price Value']
-    predicted_values = []
+    if predicted_values is None:
+        return None
 
-    # Calculate the next 3 predicted values
-    predicted_values.append(sorted_stock_price_values[1])
-    predicted_values.append(round(predicted_values[0] + (n - predicted_values[0])/2, 2))
-    predicted_values.append(round(predicted_values[1] + (predicted_values[0] - predicted_values[1])/4, 2))
+    # Extend the existing columns with new values, one day apart
+    last_timestamp = random_rows['Timestamp'][-1]
 
-    # Update existing rows with new values
-    for stock_price_values in predicted_values:
-        random_rows.append({
-            'Stock-ID': random_rows[-1]['Stock-ID'],
-            'Timestamp': random_rows[-1]['Timestamp'] + timedelta(days=1),
-            'Stock Price Value': stock_price_values
-        })
+    random_rows['Stock-ID'].extend([random_rows['Stock-ID'][-1]] * len(predicted_values))
+    random_rows['Timestamp'].extend(last_timestamp + offset for offset in PREDICTION_OFFSETS)
+    random_rows['Stock Price Value'].extend(predicted_values)
 
     return random_rows
 
@@ -124,14 +228,13 @@ def format_rows(rows):
     Formats the Timestamp and Stock Price Value for each row
 
     Args:
-        rows (list of dict): List containing stock rows.
+        rows (dict of list): Columns containing stock rows.
 
     Returns:
-        list of dict: Updated list of formated rows.
+        dict of list: Updated columns of formated rows.
     """
-    for row in rows:
-        row['Timestamp'] = row['Timestamp'].strftime('%d-%m-%Y')
-        row['Stock Price Value'] = f"{float(row['Stock Price Value']):.2f}"
+    rows['Timestamp'] = list(map(format_date, rows['Timestamp']))
+    rows['Stock Price Value'] = [f"{float(value):.2f}" for value in rows['Stock Price Value']]
 
     return rows
 
@@ -144,67 +247,70 @@ def save_predicted_stock_rows(output_path, exchange_name, file_name, predicted_r
         output_path (str): The output path where the results will be saved.
         exchange_name (str): The name of the exchange containing CSV files.
         file_name (str): The name of the file containing predicted result.
-        predicted_rows (list of dict): The list with random rows and new predicted values
+        predicted_rows (dict of list): The columns with random rows and new predicted values
     """
-    try:
-        # Generates the output path and creates exchanges if they don't exist
-        exchange_path = os.path.join(output_path, exchange_name)
-
-        if not os.path.exists(exchange_path):
-            os.makedirs(exchange_path)
-
-        # Generates the file path and formats the rows to be written
-        formated_rows = format_rows(predicted_rows)
-        file_path = os.path.join(exchange_path, file_name)
-
-        # Writes the random and predicted rows to the file
-        with open(file_path, 'w') as file:
-            writer = csv.writer(file)
-            for row in formated_rows:
-                writer.writerow(row.values())
-
-    except FileNotFoundError:
-        print(f'ERROR: The directory {output_path} does not exist.')
-    except PermissionError:
-        print(f'ERROR: Permission denied for accessing {output_path}.')
-    except Exception as e:
-        print(f'ERROR: An unexpected error occurred: {e}')
+    # Generates the file path and formats the rows to be written
+    formated_rows = format_rows(predicted_rows)
+    file_path = os.path.join(output_path, exchange_name, file_name)
+
+    # Writes the random and predicted rows to the file
+    with open(file_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerows(zip(formated_rows['Stock-ID'], formated_rows['Timestamp'], formated_rows['Stock Price Value']))
 
 
-def process_files_from_exchange(n, input_path, output_path, exchange_name):
+def process_file(output_path, exchange_name, file_path, file_name):
     """
-    Processes up to n CSV files from the specified exchange.
+    Predicts the next values for a single CSV file and saves the result.
+
+    Args:
+        output_path (str): The output path where the results will be saved.
+        exchange_name (str): The name of the exchange containing the file.
+        file_path (str): The path to the CSV file to process.
+        file_name (str): The name of the CSV file to process.
+    """
+    random_rows = get_random_rows(file_path)
+    predicted_rows = predict_next_values(random_rows)
+
+    # A flat or empty sample has no second largest value to predict from
+    if predicted_rows is None:
+        print(f'WARNING: Skipping {file_path}, it needs at least 2 unique stock price values.')
+        return
+
+    save_predicted_stock_rows(output_path, exchange_name, file_name, predicted_rows)
+
+
+def process_files_from_exchange(output_path, exchange_name, exchange_path, file_names):
+    """
+    Processes the given CSV files from the specified exchange.
 
     Args:
-        n (int): The maximum number of CSV files to process per exchange.
-        input_path (str): The input path where exchanges are located.
         output_path (str): The output path where the results will be saved.
         exchange_name (str): The name of the exchange containing files.
+        exchange_path (str): The path of the exchange containing files.
+        file_names (list of str): The names of the CSV files to process.
     """
-    try:
-        processed_files_count = 0
-        exchange_path = os.path.join(input_path, exchange_name)
-
-        # Search for all files with the CSV extension
-        for file_name in os.listdir(exchange_path):
-            file_path = os.path.join(exchange_path, file_name)
-
-            if os.path.isfile(file_path) and file_name.lower().endswith('.csv'):
-                random_rows = get_random_rows(file_path)
-                predicted_rows = predict_next_values(random_rows)
-                save_predicted_stock_rows(output_path, exchange_name, file_name, predicted_rows)
-                processed_files_count += 1
-
-            # If the number of files is reached, stop
-            if processed_files_count == n:
-                return
-
-    except FileNotFoundError:
-        print(f'ERROR: The directory {exchange_path} does not exist.')
-    except PermissionError:
-        print(f'ERROR: Permission denied for accessing {exchange_path}.')
-    except Exception as e:
-        print(f'ERROR: An unexpected error occurred: {e}')
+    if not file_names:
+        return
+
+    file_paths = [os.path.join(exchange_path, file_name) for file_name in file_names]
+
+    # Creates the output exchange once, before any of its files are saved
+    os.makedirs(os.path.join(output_path, exchange_name), exist_ok=True)
+
+    # Process the files concurrently, as they are independent of each other
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        list(executor.map(partial(process_file, output_path, exchange_name), file_paths, file_names))
+
+
+def raise_walk_error(error):
+    """
+    Raises the error reported by os.walk, which would otherwise be ignored.
+
+    Args:
+        error (OSError): The error reported by os.walk.
+    """
+    raise error
 
 
 def process_exchanges(n, input_path, output_path):
@@ -216,24 +322,72 @@ def process_exchanges(n, input_path, output_path):
         input_path (str): The input path where exchanges are located.
         output_path (str): The output path where the results will be saved.
     """
-    try:
-        # Search for all exchanges in the path
-        for exchange_name in os.listdir(input_path):
-            exchange_path = os.path.join(input_path, exchange_name)
+    exchange_names = []
+    exchange_paths = []
+    exchange_file_names = []
+
+    # Walk the exchanges and their files in a single traversal
+    # Symlinked exchanges are followed, pruning below each exchange keeps the walk from looping
+    for dir_path, dir_names, file_names in os.walk(input_path, onerror=raise_walk_error, followlinks=True):
+        if dir_path == input_path:
+            continue
+
+        # Keep the first n files with the CSV extension and don't descend below the exchange
+        dir_names[:] = []
+
+        exchange_names.append(os.path.basename(dir_path))
+        exchange_paths.append(dir_path)
+        exchange_file_names.append(list(islice((
+            file_name for file_name in file_names
+            if file_name.lower().endswith('.csv') and os.path.isfile(os.path.join(dir_path, file_name))
+        ), n)))
+
+    # Process each exchange in its own worker process
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(
+            partial(process_files_from_exchange, output_path),
+            exchange_names, exchange_paths, exchange_file_names
+        ))
+
+
+def parse_arguments():
+    """
+    Parses the command line arguments.
 
-            if os.path.isdir(exchange_path):
-                process_files_from_exchange(n, input_path, output_path, exchange_name)
+    Returns:
+        Namespace: The parsed arguments.
+    """
+    # Create the argument parser
+    parser = argparse.ArgumentParser(description='Predict values of stock price.')
 
-    except FileNotFoundError:
-        print(f'ERROR: The directory {input_path} does not exist.')
-    except PermissionError:
-        print(f'ERROR: Permission denied for accessing {input_path}.')
-    except Exception as e:
-        print(f'ERROR: An unexpected error occurred: {e}')
+    # Add the required arguments
+    parser.add_argument('--n', type=int, required=True, help='Number of files to process')
+    parser.add_argument('--input', type=str, required=True, help='Path to the input files')
+    parser.add_argument('--output', type=str, required=True, help='Path to the output files')
+
+    args = parser.parse_args()
+
+    if args.n < 0:
+        parser.error('argument --n: must be a non-negative number')
+
+    return args
 
 
 def main():
-    process_exchanges(args.n, args.input, args.output)
+    args = parse_arguments()
+
+    try:
+        process_exchanges(args.n, args.input, args.output)
+
+    except FileNotFoundError as e:
+        print(f'ERROR: The path {e.filename} does not exist.')
+        sys.exit(1)
+    except PermissionError as e:
+        print(f'ERROR: Permission denied for accessing {e.filename}.')
+        sys.exit(1)
+    except Exception as e:
+        print(f'ERROR: An unexpected error occurred: {e}')
+        sys.exit(1)
 
 
 if __name__ == "__main__":